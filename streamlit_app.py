@@ -6,12 +6,60 @@ an AI-based extractor using OpenAI's API.
 """
 
 import os  # For environment variables and file path handling
+import io  # For building the in-memory Batch API JSONL payload
 import re  # For regular expression matching
 import json  # For JSON serialization/deserialization
-import pandas as pd  # For CSV read/write and DataFrame operations
+import time  # For polling Batch API job status
+import hashlib  # For identifying an upload across Streamlit reruns
+import logging  # For server-side diagnostics (never stdout prints)
+import asyncio  # For concurrent batch dispatch of OpenAI calls
 import streamlit as st  # For building the web application UI
-from openai import OpenAI  # OpenAI client library for AI-based extraction
-from typing import List, Dict  # For type annotations
+from openai import OpenAI, AsyncOpenAI  # OpenAI client libraries for AI-based extraction
+from openai import (  # Typed errors for retry handling
+    APIConnectionError,
+    InternalServerError,
+    RateLimitError,
+)
+from tenacity import (  # Automatic retry with backoff for transient API failures
+    retry,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_exponential_jitter,
+)
+from dataclasses import dataclass  # For the frozen extractor configuration
+from types import MappingProxyType  # Read-only view for the cached examples dict
+from typing import List, Dict, Optional, Tuple  # For type annotations
+
+try:
+    # Optional: keyword automaton for the dummy extractor's fast path
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+try:
+    # Optional: exact token counting for the rate limiter's cost estimates
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+try:
+    # Optional: C-accelerated JSON decoding for model responses
+    import orjson
+except ImportError:
+    orjson = None
+
+# orjson returns the same dict/list tree and raises a ValueError subclass,
+# so it can stand in for the stdlib decoder at every response-parsing site
+_json_loads = orjson.loads if orjson is not None else json.loads
+
+_logger = logging.getLogger(__name__)
+
+if orjson is not None:
+    def _json_dumps(obj) -> str:
+        # orjson emits bytes; decode to match the stdlib signature
+        return orjson.dumps(obj).decode()
+else:
+    _json_dumps = json.dumps
 
 # — Streamlit page configuration —
 # Sets the page title, layout, and sidebar state
@@ -21,38 +69,271 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-# — OpenAI client setup —
-# Reads the API key from environment or Streamlit secrets
-client = OpenAI(
-    api_key=os.getenv("OPENAI_API_KEY", st.secrets.get("OPENAI_API_KEY", ""))
+# Static page chrome: the input banner and the custom CSS for text areas
+# and buttons, consolidated into one constant so each rerun ships a single
+# markdown component instead of two
+_STATIC_MD = """
+<div style="padding:10px; background-color:#f9f9f9; border-left:4px solid #2C7BE5; margin-bottom:15px;">
+<strong>Input:</strong> Either paste a single transcript below or upload a CSV
+(with a column named <code>transcript</code>) to process multiple records.
+</div>
+<style>
+    .stTextArea textarea { font-family: monospace; }
+    .stButton>button { background-color: #2C7BE5; color: white; }
+</style>
+"""
+
+# — Compiled regex patterns for the dummy extractor —
+# Compiled once at module load so each extraction call skips the re module's
+# per-call pattern-cache lookup and never pays a recompile.
+# Fields an extraction is expected to contain at minimum; precomputed as a
+# frozenset so the per-transcript missing-fields check allocates nothing
+_REQUIRED = frozenset(("Borrower Name", "Loan Amount"))
+
+# One pattern covers the "agent asks for the full name, next Borrower: line
+# answers" shape in a single C-level search; the lazy inter-line section
+# keeps the lookahead bounded to the nearest Borrower: line
+_RE_NAME_AFTER_ASK = re.compile(
+    r"full name[^\n]*\n(?:[^\n]*\n)*?\s*Borrower\s*:\s*([^\n]+)",
+    re.IGNORECASE,
+)
+# Anchored at line start so mid-line text (e.g. "Co-Borrower:") can't match,
+# and bounded at the newline so the engine never backtracks past the line
+_RE_BORROWER_LINE = re.compile(r"^Borrower\s*:\s*([^\n]+)",
+                               re.IGNORECASE | re.MULTILINE)
+# Leading run up to any newline/comma; interior periods stay (middle
+# initials, honorifics like "Dr."), and a trailing sentence period is
+# stripped afterwards to mirror the old rstrip('.') / split(',') cleanup
+_RE_NAME_CLEAN = re.compile(r"[^\n,]+")
+_RE_MY_NAME = re.compile(r"my name is\s+([A-Za-z ]+)", re.IGNORECASE)
+_RE_NAMES = re.compile(r"name'?s\s+([A-Za-z ]+)", re.IGNORECASE)
+# The remaining per-field patterns as (value group, anchor keywords, branch).
+# Every branch exposes exactly one named group carrying the field value, so
+# Match.lastgroup identifies which field fired. Branches with broad spans
+# (prop, balance, income) capture inside a lookahead so a long match cannot
+# consume another field nested within it. The anchor keywords are the rare
+# literals each pattern hinges on, used by the Aho-Corasick fast path below.
+# Branch literals are written lowercase and matched case-sensitively against
+# a lowercased copy of the transcript (see _scan_fields), sparing the regex
+# engine its per-character case folding.
+_FIELD_BRANCHES = (
+    ("prop", ("home at", "address is", "located at", "it's", "it’s", "its"),
+     r"(?=(?:home at|address is|located at|it['’]?s)\s*(?P<prop>.+?)\.)"),
+    ("loan_for", ("loan for",),
+     r"loan for\s*\$?(?P<loan_for>[\d,]+)"),
+    ("purchase", ("purchase price is",),
+     r"purchase price is\s*\$?(?P<purchase>[\d,]+)"),
+    ("balance", ("outstanding balance",),
+     r"(?=outstanding balance.*?\$?(?P<balance>[\d,]+))"),
+    ("term", ("-year fixed rate",),
+     r"(?P<term>\d+)-year fixed rate"),
+    ("rate", ("rate is",),
+     r"rate is\s*(?P<rate>[\d.]+%)"),
+    ("ssn", ("ssn",),
+     r"ssn\s*(?:is)?\s*(?P<ssn>[\d-]+)"),
+    ("dob", ("dob",),
+     r"dob\s*(?:is)?\s*(?P<dob>[\d/]+)"),
+    ("income_annual", ("annual income",),
+     r"(?=annual income.*?\$?(?P<income_annual>[\d,]+))"),
+    ("income_monthly", ("gross monthly income",),
+     r"(?=gross monthly income.*?\$?(?P<income_monthly>[\d,]+))"),
 )
-# Display which model is in use (for debugging/visibility)
-st.write(f"🔑 Using OpenAI model: gpt‑4o‑mini")  
 
+# Fused alternation: scans the (lowercased) transcript once for all fields
+_RE_ALL = re.compile("|".join(branch for _, _, branch in _FIELD_BRANCHES))
 
-def extract_fields_dummy(transcript: str) -> Dict[str, List[Dict]]:
+# Keyword automaton: locates candidate offsets in one O(N) pass so the
+# focused per-field regex only runs in a small window around each hit
+if ahocorasick is not None:
+    _KEYWORD_AUTOMATON = ahocorasick.Automaton()
+    for _group, _anchors, _branch in _FIELD_BRANCHES:
+        _pat = re.compile(_branch)
+        for _kw in _anchors:
+            _KEYWORD_AUTOMATON.add_word(_kw, (_group, _pat))
+    _KEYWORD_AUTOMATON.make_automaton()
+else:
+    _KEYWORD_AUTOMATON = None
+
+# Anchor literals for the no-automaton path: str.__contains__ is a C-level
+# memchr scan, far cheaper than regex setup for inputs that can't match
+_ANCHOR_LITERALS = tuple(
+    dict.fromkeys(kw for _, kws, _ in _FIELD_BRANCHES for kw in kws)
+)
+
+
+def _scan_fields(transcript: str) -> Dict[str, str]:
     """
-    Dummy extractor: Uses regex patterns to find key fields from the transcript.
-    Returns a dict with a "fields" list of field objects.
-    Each field object contains 'field_name', 'field_value', and 'confidence_score'.
+    Finds the first captured value for each field group. The transcript is
+    lowercased once (one C-level pass, length-preserving for this ASCII
+    domain) and matched with case-sensitive patterns, so the regex engine
+    skips per-character case folding; values are sliced from the original
+    text by match span to preserve their captured casing. With
+    pyahocorasick installed, a single keyword pass yields candidate offsets
+    and each focused regex only inspects a ±64/+96 byte window around its
+    hit; otherwise the fused alternation scans the text.
     """
-    fields: List[Dict] = []  # List to accumulate extracted field objects
+    found: Dict[str, str] = {}
+    lo = transcript.lower()
+    if _KEYWORD_AUTOMATON is not None:
+        for end_idx, (group, pat) in _KEYWORD_AUTOMATON.iter(lo):
+            if group in found:
+                continue
+            # pos/endpos bound the search without slicing a copy
+            m = pat.search(lo, max(0, end_idx - 64), end_idx + 96)
+            if m is None:
+                # Values can end past the window (long addresses, spelled
+                # out balances); retry unwindowed from the anchor so this
+                # path never drops a field the fused scan would find
+                m = pat.search(lo, max(0, end_idx - 64))
+            if m:
+                found[group] = transcript[m.start(group):m.end(group)]
+    else:
+        # Substring pre-filter: transcripts carrying none of the anchor
+        # literals (the common negative case) skip the regex scan entirely
+        if any(kw in lo for kw in _ANCHOR_LITERALS):
+            for m in _RE_ALL.finditer(lo):
+                group = m.lastgroup
+                if group not in found:
+                    found[group] = transcript[m.start(group):m.end(group)]
+    return found
+
+
+# Keyword gate for validate_transcript: plain literals checked with
+# str.__contains__ — a C-level substring scan with early exit on the first
+# hit ("loan" fires almost immediately in real transcripts), cheaper than
+# spinning up the regex engine for an alternation of literals
+_KEYWORDS = ("loan", "borrower", "ssn", "dob", "$", "income")
+
+# Anything shorter can't hold even one field worth of dialogue
+_MIN_TRANSCRIPT_CHARS = 20
+
+
+def normalize_fields(fields: List[Dict]) -> List[Dict]:
+    """
+    Ensures every required 1003 field appears in the output, appending
+    null-valued placeholders for any the extraction missed. The common
+    all-present case is one C-level set difference and an early return —
+    no Python loop runs unless something is actually missing.
+    """
+    missing = _REQUIRED.difference(f["field_name"] for f in fields)
+    if not missing:
+        return fields
+    fields.extend({"field_name": name, "field_value": None,
+                   "confidence_score": 0.0} for name in sorted(missing))
+    return fields
+
+
+def validate_transcript(txt: str) -> Tuple[bool, str]:
+    """
+    Cheap sanity gate run before any extractor: rejects transcripts that
+    are too short or mention no mortgage-related keyword, so obviously
+    unusable input never costs a regex scan or an API call. Returns
+    (ok, reason) with an empty reason when the transcript passes.
+    """
+    if len(txt) < _MIN_TRANSCRIPT_CHARS:
+        return (False, "Transcript is too short to contain 1003 form data.")
+    lo = txt.lower()  # One copy, shared by every keyword test
+    if not any(k in lo for k in _KEYWORDS):
+        return (False, "No mortgage-related data found in the transcript.")
+    return (True, "")
+
+
+# — Extractor configuration —
+@dataclass(frozen=True)
+class ExtractorCfg:
+    """
+    Tunables for the AI extraction paths, fixed once at startup instead of
+    being repeated inline at each call site. Frozen so every path sees the
+    same values and cache keys stay stable across reruns.
+    """
+    model: str = "gpt-4o-mini"
+    max_tokens: int = 400
 
-    # 1) Borrower Name extraction
-    name = None
-    # Look for 'Borrower: Name' pattern
-    m = re.search(r"Borrower\s*:\s*(.+)", transcript, re.IGNORECASE)
+
+_CFG = ExtractorCfg()
+
+# — OpenAI client setup —
+# Constructed once per server process via st.cache_resource, so the
+# st.secrets TOML lookup and OpenAI() construction don't repeat on every
+# Streamlit rerun.
+@st.cache_resource
+def _get_client() -> OpenAI:
+    import httpx  # Deferred: already an openai dependency, imported once here
+
+    # Reads the API key from environment or Streamlit secrets. The explicit
+    # httpx client enables HTTP/2, so sequential and concurrent requests
+    # multiplex over one kept-alive TLS connection instead of paying a
+    # ~30-80 ms handshake per connection.
+    return OpenAI(
+        api_key=os.environ.get("OPENAI_API_KEY")
+        or st.secrets.get("OPENAI_API_KEY", ""),
+        http_client=httpx.Client(
+            http2=True,
+            limits=httpx.Limits(max_connections=16,
+                                max_keepalive_connections=16),
+        ),
+    )
+
+
+client = _get_client()
+# Display which model is in use (for debugging/visibility); session-scoped
+# so the websocket frame is paid once, not on every widget interaction
+if "model_banner_shown" not in st.session_state:
+    st.write(f"🔑 Using OpenAI model: {_CFG.model}")
+    st.session_state.model_banner_shown = True
+
+
+def _extract_borrower_name(transcript: str) -> Optional[str]:
+    """
+    Borrower Name extraction: looks for a 'Borrower: Name' line and
+    refines it via common phrases, falling back to "my name is" anywhere
+    in the transcript. Returns None when no name is found.
+    """
+    # When the agent asks for the caller's full name, the next
+    # 'Borrower:' line is the one holding it; otherwise fall back to the
+    # first Borrower: line anywhere in the transcript
+    m = (_RE_NAME_AFTER_ASK.search(transcript)
+         or _RE_BORROWER_LINE.search(transcript))
     if m:
-        raw = m.group(1).strip().rstrip('.')
+        raw = m.group(1)
         # Try to refine name from common phrases
-        m2 = (re.search(r"my name is\s+([A-Za-z ]+)", raw, re.IGNORECASE)
-              or re.search(r"name'?s\s+([A-Za-z ]+)", raw, re.IGNORECASE))
-        name = m2.group(1).strip() if m2 else raw.split(",")[0].strip()
-    else:
-        # Fallback: direct "my name is" anywhere in transcript
-        m2 = re.search(r"my name is\s+([A-Za-z ]+)", transcript, re.IGNORECASE)
+        m2 = _RE_MY_NAME.search(raw) or _RE_NAMES.search(raw)
         if m2:
-            name = m2.group(1).strip()
+            return m2.group(1).strip()
+        # Otherwise keep the leading run before any comma, dropping only a
+        # trailing sentence period so "John A. Smith" survives intact
+        m3 = _RE_NAME_CLEAN.match(raw)
+        return m3.group().strip().rstrip(".") if m3 else None
+    # Fallback: direct "my name is" anywhere in transcript
+    m2 = _RE_MY_NAME.search(transcript)
+    return m2.group(1).strip() if m2 else None
+
+
+# Emission dispatch table: output order, field label, confidence score,
+# scan groups tried in priority order (e.g. "loan for" > "purchase price is"
+# > "outstanding balance"), and the value formatter.
+_FIELD_OUTPUT = (
+    ("Property Address", 0.50, ("prop",), str.strip),
+    ("Loan Amount", 0.50, ("loan_for", "purchase", "balance"),
+     lambda v: f"${v.strip()}"),
+    ("Loan Term", 0.50, ("term",), lambda v: f"{v}-year"),
+    ("Interest Rate", 0.75, ("rate",), str),
+    ("SSN", 0.90, ("ssn",), str),
+    ("Date of Birth", 0.95, ("dob",), str),
+    ("Income", 0.75, ("income_annual", "income_monthly"),
+     lambda v: f"${v.strip()}"),
+)
+
+
+def _fields_from_found(name: Optional[str], found: Dict[str, str]) -> List[Dict]:
+    """
+    Builds the ordered "fields" list from the borrower name and the raw
+    per-group values captured by a scan, driven by the _FIELD_OUTPUT
+    dispatch table (which encodes order, fallback priority, and
+    formatting).
+    """
+    fields: List[Dict] = []  # List to accumulate extracted field objects
+
     if name:
         fields.append({
             "field_name": "Borrower Name",
@@ -60,112 +341,731 @@ def extract_fields_dummy(transcript: str) -> Dict[str, List[Dict]]:
             "confidence_score": 0.50
         })
 
-    # 2) Property Address extraction
-    # Matches phrases like "home at ... ."
-    m = re.search(r"(?:home at|it['’]?s)\s*(.+?)\.", transcript, re.IGNORECASE)
-    if m:
-        fields.append({
-            "field_name": "Property Address",
-            "field_value": m.group(1).strip(),
-            "confidence_score": 0.50
-        })
+    for field_name, confidence, groups, fmt in _FIELD_OUTPUT:
+        for group in groups:
+            value = found.get(group)
+            if value is not None:
+                fields.append({
+                    "field_name": field_name,
+                    "field_value": fmt(value),
+                    "confidence_score": confidence
+                })
+                break
 
-    # 3) Loan Amount extraction
-    # Searches for patterns like "loan for $X", "purchase price is $X", or "outstanding balance $X"
-    m = (re.search(r"loan for\s*\$?([\d,]+)", transcript, re.IGNORECASE)
-         or re.search(r"purchase price is\s*\$?([\d,]+)", transcript, re.IGNORECASE)
-         or re.search(r"outstanding balance.*?\$?([\d,]+)", transcript, re.IGNORECASE))
-    if m:
-        fields.append({
-            "field_name": "Loan Amount",
-            "field_value": f"${m.group(1).strip()}",
-            "confidence_score": 0.50
-        })
+    return fields
 
-    # 4) Loan Term extraction (e.g., "30-year fixed rate")
-    m = re.search(r"(\d+)-year fixed rate", transcript, re.IGNORECASE)
-    if m:
-        fields.append({
-            "field_name": "Loan Term",
-            "field_value": f"{m.group(1)}-year",
-            "confidence_score": 0.50
-        })
 
-    # 5) Interest Rate extraction (e.g., "rate is 3.5%")
-    m = re.search(r"rate is\s*([\d.]+%)", transcript, re.IGNORECASE)
-    if m:
-        fields.append({
-            "field_name": "Interest Rate",
-            "field_value": m.group(1),
-            "confidence_score": 0.75
-        })
+@st.cache_data(show_spinner=False, max_entries=256)
+def extract_fields_dummy(transcript: str) -> Dict[str, List[Dict]]:
+    """
+    Dummy extractor: Uses regex patterns to find key fields from the transcript.
+    Returns a dict with a "fields" list of field objects.
+    Each field object contains 'field_name', 'field_value', and 'confidence_score'.
+    Memoized per transcript so Streamlit rerun storms don't redo regex work;
+    st.cache_data hands back a copy, so downstream mutation is safe.
+    """
+    name = _extract_borrower_name(transcript)
+    found = _scan_fields(transcript)
+    return {"fields": _fields_from_found(name, found)}
 
-    # 6) SSN extraction
-    m = re.search(r"SSN\s*(?:is)?\s*([\d-]+)", transcript, re.IGNORECASE)
-    if m:
-        fields.append({
-            "field_name": "SSN",
-            "field_value": m.group(1),
-            "confidence_score": 0.90
-        })
 
-    # 7) Date of Birth extraction
-    m = re.search(r"DOB\s*(?:is)?\s*([\d/]+)", transcript, re.IGNORECASE)
-    if m:
-        fields.append({
-            "field_name": "Date of Birth",
-            "field_value": m.group(1),
-            "confidence_score": 0.95
-        })
+def extract_fields_dummy_batch(transcripts: List[str]) -> List[Dict[str, List[Dict]]]:
+    """
+    Vectorized dummy extractor for CSV batches: each field pattern runs
+    across the whole column in one C-level pandas str.extract pass instead
+    of dispatching extract_fields_dummy row by row in Python. Returns one
+    result dict per transcript, in input order.
+    """
+    import pandas as pd  # Deferred: only batch runs pay the import cost
+
+    s = pd.Series(transcripts, dtype="string")
+    # One vectorized pass per field group over the whole column
+    extracted = {
+        group: s.str.extract(branch, flags=re.IGNORECASE)[group]
+        for group, _, branch in _FIELD_BRANCHES
+    }
+    results: List[Dict[str, List[Dict]]] = []
+    for i, tx in enumerate(transcripts):
+        found = {group: col.iloc[i] for group, col in extracted.items()
+                 if pd.notna(col.iloc[i])}
+        name = _extract_borrower_name(tx)
+        results.append({"fields": _fields_from_found(name, found)})
+    return results
 
-    # 8) Income extraction (annual or gross monthly)
-    m = (re.search(r"annual income.*?\$?([\d,]+)", transcript, re.IGNORECASE)
-         or re.search(r"gross monthly income.*?\$?([\d,]+)", transcript, re.IGNORECASE))
-    if m:
-        fields.append({
-            "field_name": "Income",
-            "field_value": f"${m.group(1).strip()}",
-            "confidence_score": 0.75
-        })
 
-    # Return all extracted fields
-    return {"fields": fields}
+# JSON schemas enforced server-side via structured outputs, so responses
+# are guaranteed parseable and never need a malformed-output retry.
+# The "fields" array fragment is shared by the single and packed formats.
+_FIELDS_ARRAY_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "field_name": {"type": "string"},
+            "field_value": {"type": "string"},
+            "confidence_score": {"type": "number"},
+        },
+        "required": ["field_name", "field_value", "confidence_score"],
+        "additionalProperties": False,
+    },
+}
 
+_FIELDS_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "fields1003",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {"fields": _FIELDS_ARRAY_SCHEMA},
+            "required": ["fields"],
+            "additionalProperties": False,
+        },
+    },
+}
 
-def extract_fields_via_openai(transcript: str) -> Dict:
+# Packed-batch variant: one result entry per numbered transcript
+_PACKED_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "fields1003_batch",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "results": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "id": {"type": "integer"},
+                            "fields": _FIELDS_ARRAY_SCHEMA,
+                        },
+                        "required": ["id", "fields"],
+                        "additionalProperties": False,
+                    },
+                }
+            },
+            "required": ["results"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+
+# System prompt hoisted to a module constant and kept byte-identical across
+# requests: only the user message varies, so the provider's prompt cache can
+# serve the shared prefix at a discount and improve time-to-first-token.
+# The field glossary doubles as stable context that grows the cacheable prefix.
+_SYSTEM_PROMPT = (
+    "You are a data extraction assistant. "
+    "Extract all fields from the 1003 mortgage application form "
+    "(Borrower Name, Loan Amount, Property Address, Loan Term, Interest Rate, "
+    "SSN, Date of Birth, Income, etc.) from the call transcript. "
+    "For each field, output an object with 'field_name', 'field_value', and "
+    "'confidence_score' (0–1).\n\n"
+    "Field glossary:\n"
+    "- Borrower Name: the applicant's full legal name as stated on the call.\n"
+    "- Property Address: street address of the property being financed, "
+    "including unit, city, and state when given.\n"
+    "- Loan Amount: the requested loan principal in dollars; prefer an "
+    "explicit loan figure over the purchase price.\n"
+    "- Loan Term: the repayment period, e.g. '30-year'.\n"
+    "- Interest Rate: the quoted rate as a percentage.\n"
+    "- SSN: the borrower's Social Security Number.\n"
+    "- Date of Birth: the borrower's birth date.\n"
+    "- Income: annual or gross monthly income in dollars; note which one "
+    "was stated if ambiguous.\n"
+    "Confidence scores reflect how explicitly the value was stated: 0.9+ "
+    "for values read out directly, lower for inferred or partial values."
+)
+
+
+# Lines mentioning none of these never carry 1003 field values; anything
+# else is call-opening small talk the model doesn't need to see
+# Must cover every phrasing the dummy extractor itself anchors on ("name"
+# for the my-name-is/name's forms, the it's/its property lead-in), or the
+# trim would hide values from the model that the regex path can find
+_TRIM_KEYWORDS = ("borrower", "ssn", "dob", "rate", "loan", "income",
+                  "purchase price", "address", "home at", "located at",
+                  "name", "it's", "it’s", "its")
+
+
+def _trim_transcript(transcript: str) -> str:
     """
-    AI-based extractor: Sends the transcript to OpenAI's GPT model
-    with a system prompt to extract all 1003 fields. Returns parsed JSON.
+    Drops transcript lines that mention no 1003 keyword, keeping one line
+    of context on each side of every hit. Input tokens are billed and add
+    latency roughly linearly, so trimming small talk cuts both. Returns
+    the transcript unchanged when no line matches, leaving the model to
+    report the fields as missing.
+    """
+    lines = transcript.splitlines()
+    keep = set()
+    for i, line in enumerate(lines):
+        lo = line.lower()
+        if any(kw in lo for kw in _TRIM_KEYWORDS):
+            keep.update((i - 1, i, i + 1))
+    if not keep:
+        return transcript
+    return "\n".join(line for i, line in enumerate(lines) if i in keep)
+
+
+# The static system message, allocated once; request builders share this
+# dict instead of rebuilding it per call, and the byte-identical content
+# keeps the provider's prompt-cache prefix stable
+_SYS_MSG = {"role": "system", "content": _SYSTEM_PROMPT}
+
+
+def _build_messages(transcript: str) -> List[Dict]:
+    """
+    Builds the chat messages (system + user) shared by the single and
+    batch AI extraction paths. The system message is the shared module
+    constant so every request carries an identical cacheable prefix.
     """
-    # Define the system prompt to guide the model's behavior
-    system_prompt = (
-        "You are a data extraction assistant. "
-        "Extract all fields from the 1003 mortgage application form "
-        "(Borrower Name, Loan Amount, Property Address, Loan Term, Interest Rate, "
-        "SSN, Date of Birth, Income, etc.) from the call transcript. "
-        "For each field, output an object with 'field_name', 'field_value', and "
-        "'confidence_score' (0–1). Respond ONLY with JSON: { \"fields\": [ ... ] }."
-    )
     # Prepare the user message with the actual transcript
-    user_prompt = f"Transcript:\n\"\"\"\n{transcript}\n\"\"\""
+    user_prompt = f"Transcript:\n\"\"\"\n{_trim_transcript(transcript)}\n\"\"\""
+    return [
+        _SYS_MSG,
+        {"role": "user", "content": user_prompt},
+    ]
+
+
+@retry(
+    stop=stop_after_attempt(5),
+    wait=wait_exponential_jitter(initial=1, max=30),
+    # Only transient failures are worth retrying; deterministic 4xx such
+    # as a bad API key or malformed request should surface immediately
+    retry=retry_if_exception_type(
+        (RateLimitError, APIConnectionError, InternalServerError)
+    ),
+    reraise=True,  # Surface the typed exception, not tenacity's RetryError
+)
+def _call_openai(messages: List[Dict], stream: bool = False):
+    """
+    Chat-completion call with automatic retry on transient API failures,
+    so a 2-second 429 doesn't throw away the transcript's prompt tokens.
+    Rate-limit responses sleep for the provider-suggested Retry-After
+    before tenacity's exponential backoff schedules the next attempt.
+    """
     try:
-        # Call the OpenAI chat completion API
-        resp = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user",   "content": user_prompt},
-            ],
+        return client.chat.completions.create(
+            model=_CFG.model,
+            messages=messages,
             temperature=0.0,
-            max_tokens=700,
+            max_tokens=_CFG.max_tokens,
+            response_format=_FIELDS_RESPONSE_FORMAT,
+            stream=stream,
         )
-        # Parse and return the JSON content from the response
-        return json.loads(resp.choices[0].message.content)
+    except RateLimitError as e:
+        # Honor the provider's suggested backoff, then let tenacity retry.
+        # Retry-After may be an HTTP-date rather than seconds; fall back
+        # to a short fixed delay instead of letting ValueError escape
+        try:
+            delay = float(e.response.headers.get("retry-after", 2))
+        except (TypeError, ValueError):
+            delay = 2.0
+        time.sleep(min(delay, 30.0))
+        raise
+
+
+def _parse_complete_fields(buf: str) -> List[Dict]:
+    """
+    Best-effort incremental parse of a streamed {"fields": [...]} payload:
+    a brace counter walks the buffer and returns the field objects whose
+    closing brace has already arrived, so partially streamed JSON can be
+    rendered as real fields. The final result always comes from a full
+    json.loads, so this never affects correctness.
+    """
+    fields: List[Dict] = []
+    start = buf.find("[")
+    if start == -1:
+        return fields
+    depth = 0
+    obj_start = None
+    for i in range(start + 1, len(buf)):
+        ch = buf[i]
+        if ch == "{":
+            if depth == 0:
+                obj_start = i
+            depth += 1
+        elif ch == "}":
+            depth -= 1
+            if depth == 0 and obj_start is not None:
+                try:
+                    fields.append(_json_loads(buf[obj_start:i + 1]))
+                except ValueError:
+                    pass
+                obj_start = None
+        elif ch == "]" and depth == 0:
+            break
+    return fields
+
+
+# Bump to invalidate cached AI extractions whenever the prompt changes
+PROMPT_VERSION = 1
+
+
+@st.cache_data(persist="disk", show_spinner=False, ttl=7 * 86400,
+               max_entries=512)
+def _cached_openai(transcript: str, model: str, prompt_version: int,
+                   _placeholder=None) -> Dict:
+    """
+    Disk-persisted cache around the AI extraction call. Streamlit keys
+    entries on (transcript, model, prompt_version), so re-running an
+    identical transcript is a local read instead of a fresh API call.
+    Cache misses stream the completion; when a placeholder is supplied
+    (leading-underscore args are excluded from the cache key) the partial
+    JSON renders progressively as chunks arrive, so the first fields are
+    visible at time-to-first-token instead of after the full completion.
+    """
+    stream = _call_openai(_build_messages(transcript), stream=True)
+    buf = io.StringIO()
+    for chunk in stream:
+        delta = chunk.choices[0].delta.content or ""
+        if delta:
+            buf.write(delta)
+            if _placeholder is not None:
+                # Render the fields whose objects are already complete
+                done = _parse_complete_fields(buf.getvalue())
+                if done:
+                    _placeholder.json({"fields": done})
+    if _placeholder is not None:
+        # Final result is rendered by the caller; drop the partial view
+        _placeholder.empty()
+    return _json_loads(buf.getvalue())
+
+
+def _retry_with_feedback(transcript: str, error: str) -> Dict:
+    """
+    Last-resort recovery for a response that failed validation despite the
+    enforced schema: re-ask the model with the error appended as feedback,
+    up to 2 attempts with a short linear backoff.
+    """
+    messages = _build_messages(transcript)
+    for attempt in range(2):
+        time.sleep(1.0 * (attempt + 1))
+        messages.append({
+            "role": "user",
+            "content": f"Your output had error: {error}. Fix and retry.",
+        })
+        try:
+            resp = _call_openai(messages)
+            result = _json_loads(resp.choices[0].message.content)
+            if isinstance(result, dict) and "fields" in result:
+                return result
+            error = "response JSON did not contain a 'fields' array"
+        except ValueError as e:
+            error = str(e)
+    return {"error": f"Validation failed after feedback retries: {error}"}
+
+
+def extract_fields_via_openai(transcript: str, placeholder=None) -> Dict:
+    """
+    AI-based extractor: Sends the transcript to OpenAI's GPT model
+    with a system prompt to extract all 1003 fields. Returns parsed JSON.
+    Identical transcripts are served from the persistent cache; fresh
+    calls stream progressively into the optional placeholder.
+    """
+    try:
+        result = _cached_openai(transcript, _CFG.model, PROMPT_VERSION,
+                                _placeholder=placeholder)
+        if not (isinstance(result, dict) and "fields" in result):
+            # Cached entry doesn't match the expected schema: evict it
+            # and fetch a fresh response once
+            _cached_openai.clear(transcript, _CFG.model, PROMPT_VERSION)
+            result = _cached_openai(transcript, _CFG.model, PROMPT_VERSION,
+                                    _placeholder=placeholder)
+        if not (isinstance(result, dict) and "fields" in result):
+            # Still invalid: re-ask the model with the error as feedback
+            result = _retry_with_feedback(
+                transcript, "response JSON did not contain a 'fields' array"
+            )
+        return result
+    except RateLimitError as e:
+        # Typed marker lets the UI branch on an integer compare instead of
+        # scanning the message for "quota"/"429" wording
+        return {"error": str(e), "error_code": 429}
     except Exception as e:
         # Return error message if the API call fails
         return {"error": str(e)}
 
 
+# Maximum number of OpenAI requests kept in flight during a CSV batch;
+# caps concurrency (RPM) so large uploads don't trip the account's rate limit.
+MAX_CONCURRENT_REQUESTS = 8
+
+# Account tokens-per-minute budget for gpt-4o-mini; the rate limiter debits
+# estimated request costs against this and reconciles from live headers.
+TPM_BUDGET = 200_000
+
+
+@st.cache_resource
+def _token_encoder():
+    """Tokenizer for cost estimates; None when tiktoken isn't installed."""
+    return tiktoken.encoding_for_model(_CFG.model) if tiktoken else None
+
+
+def _estimate_tokens(transcript: str) -> int:
+    """
+    Estimated prompt + completion token cost of one extraction call,
+    using tiktoken when available and ~4 chars/token otherwise.
+    """
+    enc = _token_encoder()
+    if enc is not None:
+        prompt_tokens = len(enc.encode(_SYSTEM_PROMPT)) + len(enc.encode(transcript))
+    else:
+        prompt_tokens = (len(_SYSTEM_PROMPT) + len(transcript)) // 4
+    # Assume the full completion budget is spent
+    return prompt_tokens + _CFG.max_tokens
+
+
+class RateLimiter:
+    """
+    Cost-aware token bucket for concurrent API dispatch. Each request
+    debits its estimated prompt+completion tokens before going out, and
+    the bucket is reconciled from the x-ratelimit-remaining-tokens header
+    of every response, so bursts stay under the account's TPM instead of
+    triggering 429 cascades that each waste a full round-trip.
+    """
+
+    def __init__(self, tokens_per_minute: int) -> None:
+        self.capacity = float(tokens_per_minute)
+        self.tokens = float(tokens_per_minute)
+        self.last_update = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity,
+            self.tokens + self.capacity * (now - self.last_update) / 60.0,
+        )
+        self.last_update = now
+
+    async def acquire(self, cost: float) -> None:
+        # A full bucket is the most the budget can ever hold; clamp so an
+        # oversized request drains the bucket and proceeds instead of
+        # waiting forever for a level the bucket cannot reach
+        cost = min(cost, self.capacity)
+        # Wait until the bucket holds enough tokens for this request
+        while True:
+            self._refill()
+            if self.tokens >= cost:
+                self.tokens -= cost
+                return
+            await asyncio.sleep(
+                max((cost - self.tokens) * 60.0 / self.capacity, 0.05)
+            )
+
+    def reconcile(self, headers) -> None:
+        # Trust the provider's live view of the remaining token budget
+        remaining = headers.get("x-ratelimit-remaining-tokens")
+        if remaining is not None:
+            try:
+                self.tokens = min(self.capacity, float(remaining))
+                self.last_update = time.monotonic()
+            except ValueError:
+                pass
+
+
+# Number of transcripts packed into a single chat-completion request;
+# amortizes the network round-trip and shared system prompt across rows
+PACK_SIZE = 10
+
+
+def _build_packed_messages(transcripts: List[str]) -> List[Dict]:
+    """
+    Builds the chat messages for a packed batch: the shared system prompt
+    plus one user message holding all transcripts between numbered
+    delimiters, with instructions to return one result entry per number.
+    """
+    instructions = (
+        "Multiple transcripts are delimited below. Extract the 1003 fields "
+        "for each one and return one results entry per transcript, with "
+        "'id' set to the transcript number."
+    )
+    body = "\n\n".join(
+        f"===TRANSCRIPT {i}===\n{_trim_transcript(tx)}\n===END {i}==="
+        for i, tx in enumerate(transcripts)
+    )
+    return [
+        _SYS_MSG,
+        {"role": "user", "content": f"{instructions}\n\n{body}"},
+    ]
+
+
+async def _extract_pack_async(pack: List[str], sem: asyncio.Semaphore,
+                              limiter: RateLimiter,
+                              aclient: AsyncOpenAI) -> List[Dict]:
+    """
+    Async worker for one pack of transcripts: acquires the semaphore and
+    the token budget, sends the packed request, and returns one result
+    dict per transcript in pack order (or error dicts for the whole pack).
+    """
+    async with sem:
+        try:
+            await limiter.acquire(sum(_estimate_tokens(tx) for tx in pack))
+            raw = await aclient.chat.completions.with_raw_response.create(
+                model=_CFG.model,
+                messages=_build_packed_messages(pack),
+                temperature=0.0,
+                max_tokens=min(_CFG.max_tokens * len(pack), 16000),
+                response_format=_PACKED_RESPONSE_FORMAT,
+            )
+            limiter.reconcile(raw.headers)
+            resp = raw.parse()
+            # Server logs show prompt-cache effectiveness across the batch
+            usage = getattr(resp, "usage", None)
+            details = getattr(usage, "prompt_tokens_details", None)
+            if details is not None:
+                _logger.info("prompt tokens cached: %s/%s",
+                             details.cached_tokens, usage.prompt_tokens)
+            parsed = _json_loads(resp.choices[0].message.content)
+            # Map numbered entries back onto pack positions
+            results = [{"error": "No result returned for this transcript."}
+                       for _ in pack]
+            for entry in parsed.get("results", []):
+                i = entry.get("id")
+                if isinstance(i, int) and 0 <= i < len(pack):
+                    results[i] = {"fields": entry.get("fields", [])}
+            return results
+        except RateLimitError as e:
+            return [{"error": str(e), "error_code": 429} for _ in pack]
+        except Exception as e:
+            return [{"error": str(e)} for _ in pack]
+
+
+def extract_fields_via_openai_batch(transcripts: List[str]) -> List[Dict]:
+    """
+    AI-based batch extractor: packs transcripts into groups of PACK_SIZE
+    per request and dispatches the packed requests concurrently via
+    AsyncOpenAI + asyncio.gather, so a CSV batch pays roughly one HTTP
+    round-trip per PACK_SIZE rows. A shared semaphore caps in-flight
+    requests (RPM) and a token bucket keeps the burst under the account's
+    TPM. Results are returned in the same order as the input transcripts.
+    """
+    packs = [transcripts[i:i + PACK_SIZE]
+             for i in range(0, len(transcripts), PACK_SIZE)]
+
+    async def _run() -> List[List[Dict]]:
+        import httpx
+
+        # HTTP/2 lets the concurrent packs multiplex over one connection
+        aclient = AsyncOpenAI(
+            api_key=client.api_key,
+            http_client=httpx.AsyncClient(
+                http2=True,
+                limits=httpx.Limits(max_connections=16,
+                                    max_keepalive_connections=16),
+            ),
+        )
+        sem = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+        limiter = RateLimiter(TPM_BUDGET)
+        try:
+            return await asyncio.gather(
+                *[_extract_pack_async(pack, sem, limiter, aclient)
+                  for pack in packs]
+            )
+        finally:
+            await aclient.close()
+
+    # Flatten pack results back into one list aligned with the input
+    return [result for pack in asyncio.run(_run()) for result in pack]
+
+
+# CSV uploads above this row count go through the OpenAI Batch API, which
+# runs requests out-of-band at half the synchronous token price.
+BATCH_API_THRESHOLD = 10
+
+# Maximum number of 10-second polls before the UI gives the script thread
+# back; the job id stays in session state, so re-submitting the same file
+# resumes polling instead of creating a new job.
+BATCH_POLL_LIMIT = 30
+
+
+def extract_fields_via_batch_api(transcripts: List[str]) -> List[Dict]:
+    """
+    AI-based bulk extractor using the OpenAI Batch API: uploads one JSONL
+    request per transcript, lets OpenAI process the job out-of-band, and
+    polls until completion. Results come back in input order. The job id
+    is kept in session state so a Streamlit rerun resumes polling instead
+    of resubmitting (and re-billing) the same upload.
+    """
+    # Identify this exact upload so reruns can find the in-flight job
+    job_key = hashlib.sha256("\x1e".join(transcripts).encode()).hexdigest()
+
+    if st.session_state.get("batch_job_key") != job_key:
+        # Build one JSONL request line per transcript
+        lines = []
+        for i, tx in enumerate(transcripts):
+            lines.append(_json_dumps({
+                "custom_id": str(i),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": _CFG.model,
+                    "messages": _build_messages(tx),
+                    "temperature": 0.0,
+                    "max_tokens": _CFG.max_tokens,
+                    "response_format": _FIELDS_RESPONSE_FORMAT,
+                },
+            }))
+        payload = io.BytesIO("\n".join(lines).encode("utf-8"))
+        # Upload the JSONL and create the batch job; failures surface as
+        # error results like every other extraction path
+        try:
+            batch_file = client.files.create(
+                file=("formsiq_batch.jsonl", payload), purpose="batch"
+            )
+            batch = client.batches.create(
+                input_file_id=batch_file.id,
+                endpoint="/v1/chat/completions",
+                completion_window="24h",
+            )
+        except Exception as e:
+            return [{"error": str(e)} for _ in transcripts]
+        st.session_state["batch_job_key"] = job_key
+        st.session_state["batch_job_id"] = batch.id
+
+    # Poll the job until it reaches a terminal state or the poll budget
+    # runs out — the completion window is 24h, so the script thread must
+    # not block on a slow job with no way to cancel
+    batch_id = st.session_state["batch_job_id"]
+    with st.status("Batch job submitted…", expanded=False) as status:
+        for _ in range(BATCH_POLL_LIMIT):
+            try:
+                batch = client.batches.retrieve(batch_id)
+            except Exception as e:
+                return [{"error": str(e)} for _ in transcripts]
+            status.update(label=f"Batch job {batch_id}: {batch.status}")
+            if batch.status in ("completed", "failed", "expired", "cancelled"):
+                break
+            time.sleep(10)
+
+    if batch.status not in ("completed", "failed", "expired", "cancelled"):
+        return [{"error": f"Batch job {batch_id} is still running; submit "
+                          "the same file again to resume checking it."}
+                for _ in transcripts]
+
+    if batch.status != "completed":
+        # Dead job: drop the session keys so re-submitting the same file
+        # creates a fresh job instead of retrieving this one forever
+        st.session_state.pop("batch_job_key", None)
+        st.session_state.pop("batch_job_id", None)
+        return [{"error": f"Batch job ended with status '{batch.status}'."}
+                for _ in transcripts]
+
+    # Download the output file and map each line back to its input row
+    results: List[Dict] = [{"error": "No result returned for this transcript."}
+                           for _ in transcripts]
+    try:
+        output = client.files.content(batch.output_file_id).text
+    except Exception as e:
+        return [{"error": str(e)} for _ in transcripts]
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        entry = _json_loads(line)
+        i = int(entry["custom_id"])
+        try:
+            content = entry["response"]["body"]["choices"][0]["message"]["content"]
+            results[i] = _json_loads(content)
+        except Exception as e:
+            results[i] = {"error": str(e)}
+    return results
+
+
+def _batch_results_frame(results: List[Dict]) -> "pd.DataFrame":
+    """
+    Wide summary frame for batch results: one row per transcript, one
+    column per extracted field name (plus an error column when present),
+    so a whole CSV renders as a single table instead of per-row widgets.
+
+    Built column-wise: field entries append onto three parallel arrays
+    (row id / name / value) materialized as one DataFrame allocation and
+    pivoted wide, instead of allocating N·K intermediate per-row dicts.
+    """
+    import pandas as pd  # Deferred: only batch runs pay the import cost
+
+    row_ids: List[int] = []
+    names: List[str] = []
+    values: List[Optional[str]] = []
+    for row, res in enumerate(results, start=1):
+        for f in res.get("fields", []):
+            row_ids.append(row)
+            names.append(f["field_name"])
+            values.append(f["field_value"])
+        if "error" in res:
+            row_ids.append(row)
+            names.append("error")
+            values.append(res["error"])
+    long = pd.DataFrame({"row": row_ids, "name": names, "value": values})
+    wide = long.pivot_table(index="row", columns="name", values="value",
+                            aggfunc="first")
+    # pivot_table sorts columns alphabetically; restore first-seen field
+    # order and re-add rows whose extraction produced no fields at all
+    order = list(dict.fromkeys(names))
+    return (wide.reindex(index=range(1, len(results) + 1), columns=order)
+                .rename_axis(index=None, columns=None))
+
+
+@st.fragment
+def _render_transcript_result(idx: int, tx: str, use_ai: str,
+                              batch_result: Optional[Dict]) -> None:
+    """
+    Renders one transcript's preview and extraction result. Scoped as a
+    fragment so widget updates inside it (streaming placeholder, spinner)
+    rerun only this block instead of the whole script.
+    """
+    st.markdown(f"---\n**Transcript #{idx}:**")
+    # Show a preview of the transcript (read-only)
+    st.text_area(f"Preview #{idx}", tx, height=120, disabled=True, key=f"tx_{idx}")
+    # Reject obviously unusable input before spending extractor work on it
+    ok, reason = validate_transcript(tx)
+    if not ok:
+        st.warning(reason)
+        return
+    with st.spinner(f"Processing transcript #{idx}…"):
+        # Choose between dummy or AI extractor
+        if use_ai == "AI extractor":
+            # Reuse the concurrently fetched result when batching;
+            # single transcripts stream into a live placeholder
+            result = (batch_result if batch_result is not None
+                      else extract_fields_via_openai(tx, placeholder=st.empty()))
+            # Handle case where AI extractor returns no fields
+            if isinstance(result, dict) and "fields" in result and not result["fields"]:
+                st.info("There is no data relevant to 1003 form from the provided transcript. Please check again.")
+                return
+            # Handle API rate limit or quota errors (typed marker set by
+            # the extractors when RateLimitError exhausted its retries)
+            if result.get("error_code") == 429:
+                st.error(
+                    "🚫 AI extractor is currently overloaded or out of quota.\n"
+                    "Please switch to **Dummy extractor** in the sidebar and run again."
+                )
+                return
+        else:
+            # Use simpler regex-based extractor (vectorized result
+            # when the transcripts came from a CSV batch)
+            result = (batch_result if batch_result is not None
+                      else extract_fields_dummy(tx))
+
+    # Display errors or JSON results
+    if "error" in result:
+        st.error(f"Error: {result['error']}")
+    else:
+        # Flag required 1003 fields the extraction didn't find, then pad
+        # them into the JSON as explicit nulls so the output shape is stable
+        missing = _REQUIRED.difference(
+            f["field_name"] for f in result.get("fields", ())
+        )
+        if missing:
+            st.warning(f"Missing required fields: {', '.join(sorted(missing))}")
+            result = dict(result,
+                          fields=normalize_fields(list(result.get("fields", ()))))
+        st.subheader("JSON Output")
+        st.json(result)
+
+
 # — Initialize session state for transcript input and example selection —
 if "transcript_input" not in st.session_state:
     st.session_state.transcript_input = ""
@@ -182,9 +1082,17 @@ use_ai = st.sidebar.radio(
 st.sidebar.markdown("---")
 st.sidebar.header("🚀 Mock Transcripts")
 
-# Load pre-saved example transcripts for quick testing
-with open("mock_transcripts.json") as f:
-    examples = json.load(f)
+# Load pre-saved example transcripts for quick testing.
+# Cached as a resource so the file is read and parsed once per server
+# process instead of on every Streamlit rerun; the read-only proxy keeps
+# callers from mutating the shared dict.
+@st.cache_resource
+def _load_examples() -> MappingProxyType:
+    with open("mock_transcripts.json") as f:
+        return MappingProxyType(json.load(f))
+
+
+examples = _load_examples()
 
 st.sidebar.selectbox(
     "Choose an example",
@@ -200,32 +1108,17 @@ if st.sidebar.button("Load example"):
 st.title("📝FormsiQ 1003‑Form Field Extractor Model")
 st.markdown("Paste or upload transcripts, then click **Extract Fields**.")
 
-# Informational banner for input options
-st.markdown(
-    """
-<div style="padding:10px; background-color:#f9f9f9; border-left:4px solid #2C7BE5; margin-bottom:15px;">
-<strong>Input:</strong> Either paste a single transcript below or upload a CSV
-(with a column named <code>transcript</code>) to process multiple records.
-</div>
-""", unsafe_allow_html=True
-)
-
-# File uploader for batch processing via CSV
-uploaded_file = st.file_uploader("Upload CSV file", type=["csv"])
-transcripts: List[str] = []
+# Static page chrome — informational banner plus the custom CSS — rendered
+# as one component message per rerun instead of two separate markdown blocks
+st.markdown(_STATIC_MD, unsafe_allow_html=True)
 
-if uploaded_file:
-    try:
-        df = pd.read_csv(uploaded_file)
-        if "transcript" in df.columns:
-            st.success(f"Loaded {len(df)} transcripts from {uploaded_file.name}")
-            transcripts = df["transcript"].dropna().astype(str).tolist()
-        else:
-            st.error("CSV must contain a 'transcript' column.")
-    except Exception as e:
-        st.error(f"Error reading CSV: {e}")
-else:
-    # Single transcript textarea if no CSV is uploaded
+# Inputs live inside a form so editing them (typing, sidebar toggles)
+# doesn't rerun extraction; the script only re-enters the processing
+# branch on an explicit submit.
+with st.form("extract"):
+    # File uploader for batch processing via CSV
+    uploaded_file = st.file_uploader("Upload CSV file", type=["csv"])
+    # Single transcript textarea used when no CSV is uploaded
     transcript = st.text_area(
         "Call Transcript",
         value=st.session_state.transcript_input,
@@ -233,50 +1126,114 @@ else:
         key="transcript_input",
         placeholder="Paste your call transcript here…"
     )
-    if transcript.strip():
-        transcripts = [transcript.strip()]
+    submitted = st.form_submit_button("Extract Fields")
+
+transcripts: List[str] = []
+
+@st.cache_data(show_spinner=False)
+def _parse_transcripts_csv(data: bytes) -> List[str]:
+    """
+    Parses the uploaded CSV's transcript column, keyed on the file bytes.
+    Streamlit reruns the script on every widget interaction, so without
+    this cache any sidebar click after an upload would re-parse the whole
+    file; an unchanged upload is an O(1) hit on the bytes hash.
+    """
+    # Deferred import: sessions that never upload a CSV skip pandas'
+    # interpreter-startup and memory cost entirely
+    import pandas as pd
+
+    # Parse only the transcript column, in fixed-size chunks, so wide
+    # or long CSVs never materialize unused columns in memory
+    df_iter = pd.read_csv(
+        io.BytesIO(data),
+        usecols=["transcript"],
+        dtype={"transcript": "string"},
+        engine="c",
+        chunksize=512,
+    )
+    return [tx for chunk in df_iter
+            for tx in chunk["transcript"].dropna().tolist()]
 
-# — Extract Fields button and processing —
-if st.button("Extract Fields"):
+
+if uploaded_file:
+    try:
+        transcripts = _parse_transcripts_csv(uploaded_file.getvalue())
+        st.success(f"Loaded {len(transcripts)} transcripts from {uploaded_file.name}")
+    except ValueError:
+        # usecols raises ValueError when the column is absent
+        st.error("CSV must contain a 'transcript' column.")
+    except Exception as e:
+        st.error(f"Error reading CSV: {e}")
+elif transcript.strip():
+    transcripts = [transcript.strip()]
+
+# — Extract Fields processing (runs only on form submit) —
+if submitted:
     if not transcripts:
         st.error("Please provide at least one transcript (paste or CSV upload).")
     else:
-        for idx, tx in enumerate(transcripts, start=1):
-            st.markdown(f"---\n**Transcript #{idx}:**")
-            # Show a preview of the transcript (read-only)
-            st.text_area(f"Preview #{idx}", tx, height=120, disabled=True, key=f"tx_{idx}")
-            with st.spinner(f"Processing transcript #{idx}…"):
-                # Choose between dummy or AI extractor
-                if use_ai == "AI extractor":
-                    result = extract_fields_via_openai(tx)
-                    # Handle case where AI extractor returns no fields
-                    if isinstance(result, dict) and "fields" in result and not result["fields"]:
-                        st.info("There is no data relevant to 1003 form from the provided transcript. Please check again.")
-                        continue
-                    # Handle API rate limit or quota errors
-                    if "error" in result and any(code in result["error"].lower() for code in ("quota", "429", "rate limit")):
-                        st.error(
-                            "🚫 AI extractor is currently overloaded or out of quota.\n"
-                            "Please switch to **Dummy extractor** in the sidebar and run again."
-                        )
-                        continue
-                else:
-                    # Use simpler regex-based extractor
-                    result = extract_fields_dummy(tx)
+        # For multi-transcript runs, dispatch all extractions up front
+        # instead of paying one round-trip per loop iteration.
+        batch_results = None
+        if len(transcripts) > 1:
+            # Deduplicate before dispatch: identical rows (common in joined
+            # or mock CSVs) are extracted once and results fanned back out
+            unique_transcripts: List[str] = []
+            inverse: List[int] = []
+            seen_at: Dict[str, int] = {}
+            for tx in transcripts:
+                if tx not in seen_at:
+                    seen_at[tx] = len(unique_transcripts)
+                    unique_transcripts.append(tx)
+                inverse.append(seen_at[tx])
 
-            # Display errors or JSON results
-            if "error" in result:
-                st.error(f"Error: {result['error']}")
+            if use_ai == "AI extractor":
+                # Validate before dispatch so junk rows never cost an API
+                # call; rejected rows get an error result in place
+                checks = [validate_transcript(tx) for tx in unique_transcripts]
+                valid = [tx for tx, (ok, _) in zip(unique_transcripts, checks)
+                         if ok]
+                if uploaded_file and len(valid) > BATCH_API_THRESHOLD:
+                    # Large CSV jobs run out-of-band via the Batch API
+                    valid_results = extract_fields_via_batch_api(valid)
+                elif valid:
+                    with st.spinner(f"Processing {len(valid)} unique transcripts concurrently…"):
+                        valid_results = extract_fields_via_openai_batch(valid)
+                else:
+                    valid_results = []
+                results_iter = iter(valid_results)
+                unique_results = [next(results_iter) if ok
+                                  else {"error": reason}
+                                  for ok, reason in checks]
             else:
-                st.subheader("JSON Output")
-                st.json(result)
+                # Dummy extraction over a CSV runs vectorized in one pass
+                unique_results = extract_fields_dummy_batch(unique_transcripts)
+            # Map unique results back onto the original row order
+            batch_results = [unique_results[i] for i in inverse]
+        if batch_results is not None and uploaded_file:
+            # CSV runs render as two tables — truncated previews and the
+            # wide results frame — instead of per-row widgets: one
+            # component each to serialize to the browser, not O(N). The
+            # per-row JSON stays available lazily inside expanders.
+            import pandas as pd
 
-# — Custom CSS styling for text areas and buttons —
-st.markdown(
-    """
-<style>
-    .stTextArea textarea { font-family: monospace; }
-    .stButton>button { background-color: #2C7BE5; color: white; }
-</style>
-""", unsafe_allow_html=True
-)
+            st.subheader("Batch Results")
+            preview_df = pd.DataFrame(
+                {"transcript": [tx[:200] + "…" if len(tx) > 200 else tx
+                                for tx in transcripts]},
+                index=range(1, len(transcripts) + 1),
+            )
+            st.dataframe(preview_df, use_container_width=True)
+            st.dataframe(_batch_results_frame(batch_results),
+                         use_container_width=True)
+            for idx, res in enumerate(batch_results, start=1):
+                with st.expander(f"Transcript #{idx} JSON"):
+                    st.json(res)
+        else:
+            # Each transcript renders inside its own fragment, so updates to
+            # one block don't rerun the whole page for every other transcript
+            for idx, tx in enumerate(transcripts, start=1):
+                _render_transcript_result(
+                    idx, tx, use_ai,
+                    batch_results[idx - 1] if batch_results is not None else None,
+                )